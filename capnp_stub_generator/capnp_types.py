@@ -1,25 +1,31 @@
 """Types definitions that are common in capnproto schemas."""
 from __future__ import annotations
 
+import sys
 from types import ModuleType
 from typing import Dict
 from typing import Tuple
 
+# The keys and values are interned, as this is the hot lookup for every field during generation.
+# Interned keys let the dict probe short-circuit on identity when callers intern their lookup strings, too.
 CAPNP_TYPE_TO_PYTHON = {
-    "void": "None",
-    "bool": "bool",
-    "int8": "int",
-    "int16": "int",
-    "int32": "int",
-    "int64": "int",
-    "uint8": "int",
-    "uint16": "int",
-    "uint32": "int",
-    "uint64": "int",
-    "float32": "float",
-    "float64": "float",
-    "text": "str",
-    "data": "bytes",
+    sys.intern(capnp_type): sys.intern(python_type)
+    for capnp_type, python_type in {
+        "void": "None",
+        "bool": "bool",
+        "int8": "int",
+        "int16": "int",
+        "int32": "int",
+        "int64": "int",
+        "uint8": "int",
+        "uint16": "int",
+        "uint32": "int",
+        "uint64": "int",
+        "float32": "float",
+        "float64": "float",
+        "text": "str",
+        "data": "bytes",
+    }.items()
 }
 
 
@@ -67,6 +67,14 @@ def setup_parser() -> argparse.ArgumentParser:
         help="path or glob expressions to exclude from path matches.",
     )
 
+    parser.add_argument(
+        "--no-format",
+        dest="format",
+        default=True,
+        action="store_false",
+        help="skip formatting the generated stubs with black and isort.",
+    )
+
     _add_recursive_argument(parser)
 
     return parser
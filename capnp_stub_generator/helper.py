@@ -4,6 +4,7 @@ from __future__ import annotations
 from copy import copy
 from dataclasses import dataclass
 from dataclasses import field
+from functools import lru_cache
 from typing import Any
 
 BUILDER_NAME = "Builder"
@@ -242,6 +243,7 @@ class TypeHintedVariable:
         )
 
 
+@lru_cache(maxsize=None)
 def replace_capnp_suffix(original: str) -> str:
     """If found, replaces the .capnp suffix in a string with _capnp.
 
@@ -253,8 +255,10 @@ def replace_capnp_suffix(original: str) -> str:
     Returns:
         str: The string with the replaced suffix.
     """
-    if original.endswith(".capnp"):
-        return original.replace(".capnp", "_capnp")
+    base = original.removesuffix(".capnp")
+
+    if len(base) != len(original):
+        return base + "_capnp"
 
     else:
         return original
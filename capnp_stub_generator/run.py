@@ -5,12 +5,14 @@ import argparse
 import glob
 import logging
 import os.path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import PurePath
 from types import ModuleType
 import re
 
-import black
 import capnp  # type: ignore
-import isort
 from capnp_stub_generator.capnp_types import ModuleRegistryType
 from capnp_stub_generator.helper import replace_capnp_suffix
 from capnp_stub_generator.writer import Writer
@@ -23,6 +25,20 @@ logger = logging.getLogger(__name__)
 PYI_SUFFIX = ".pyi"
 PY_SUFFIX = ".py"
 LINE_LENGTH = 120
+WRITE_BUFFER_SIZE = 512 * 1024
+
+
+def fix_syntax(raw_input: str) -> str:
+    """Fixes generated lines that are not valid Python syntax.
+
+    Args:
+        raw_input (str): The raw generated output.
+
+    Returns:
+        str: The output with invalid lines commented out.
+    """
+    # Lines ending in "]Builder" or "]Reader" are already commented out by `Scope.add` at emission time.
+    return raw_input.replace("from:", "# from:")  # fix invalid identifier
 
 
 def format_outputs(raw_input: str, is_pyi: bool, line_length: int = LINE_LENGTH) -> str:
@@ -35,35 +51,398 @@ def format_outputs(raw_input: str, is_pyi: bool, line_length: int = LINE_LENGTH)
     Returns:
         str: The formatted outputs.
     """
+    # Imported lazily, as both packages are heavy and are not needed when formatting is skipped.
+    import black
+    import isort
+
     # FIXME: Extract config from dev_policies
-    raw_input = raw_input.replace("from:", "# from:")  # fix invalid identifier
-    # comment out lines that include "]Builder" or "]Reader" as these are syntax errors
-    raw_input = re.sub(r"^(.*])Builder$", r"# \1Builder", raw_input, flags=re.MULTILINE)
-    raw_input = re.sub(r"^(.*])Reader$", r"# \1Reader", raw_input, flags=re.MULTILINE)
+    raw_input = fix_syntax(raw_input)
     sorted_imports = isort.code(raw_input, config=isort.Config(profile="black", line_length=line_length))
     return black.format_str(sorted_imports, mode=black.Mode(is_pyi=is_pyi, line_length=line_length))
 
 
-def generate_stubs(module: ModuleType, module_registry: ModuleRegistryType, output_file_path: str):
+def generate_stubs(
+    module: ModuleType, module_registry: ModuleRegistryType, output_file_path: str, format_output: bool = True
+):
     """Entry-point for generating *.pyi stubs from a module definition.
 
     Args:
         module (ModuleType): The module to generate stubs for.
         module_registry (ModuleRegistryType): A registry of all detected modules.
         output_file_path (str): The name of the output stub files, without file extension.
+        format_output (bool): Whether to run `black` and `isort` on the outputs. Optional, defaults to True.
     """
     writer = Writer(module, module_registry)
     writer.generate_all_nested()
 
-    for outputs, suffix, is_pyi in zip((writer.dumps_pyi(), writer.dumps_py()), (PYI_SUFFIX, PY_SUFFIX), (True, False)):
-        formatted_output = format_outputs(outputs, is_pyi)
+    def emit_output(outputs: str, suffix: str, is_pyi: bool):
+        formatted_output = format_outputs(outputs, is_pyi) if format_output else fix_syntax(outputs)
+
+        # Write the encoded output in one buffered batch, rather than going through the text-IO layer.
+        # Writing to a temporary file first and renaming it into place publishes the stub atomically,
+        # so a partially-written stub never appears under the final name.
+        temporary_file_path = output_file_path + suffix + ".tmp"
+
+        with open(temporary_file_path, "wb", buffering=WRITE_BUFFER_SIZE) as output_file:
+            output_file.write(formatted_output.encode("utf-8"))
 
-        with open(output_file_path + suffix, "w", encoding="utf8") as output_file:
-            output_file.write(formatted_output)
+        os.replace(temporary_file_path, output_file_path + suffix)
+
+    # Emit both outputs concurrently, so the write of one overlaps with the formatting of the other.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for _ in executor.map(
+            emit_output, (writer.dumps_pyi(), writer.dumps_py()), (PYI_SUFFIX, PY_SUFFIX), (True, False)
+        ):
+            pass
 
     logger.info("Wrote stubs to '%s(%s/%s)'.", output_file_path, PYI_SUFFIX, PY_SUFFIX)
 
 
+# Per-process module registry, set up by `_init_worker`. Parsed capnp modules cannot be pickled,
+# so each worker process loads the schemas itself, instead of receiving them from the parent process.
+_worker_modules: dict[str, ModuleType] = {}
+_worker_registry: ModuleRegistryType = {}
+_worker_format_output: bool = True
+
+
+def _init_worker(schema_paths: list[str], format_output: bool):
+    """Load all detected schemas into the registry of a worker process.
+
+    Args:
+        schema_paths (list[str]): The paths of all *.capnp schemas to load.
+        format_output (bool): Whether generated stubs are formatted with `black` and `isort`.
+    """
+    global _worker_format_output
+    _worker_format_output = format_output
+
+    # One parser is shared across all loads, with the schema directories preloaded as import roots,
+    # so schemas that are imported by several modules are only parsed once.
+    parser = capnp.SchemaParser()
+    import_roots = sorted({os.path.dirname(path) for path in schema_paths})
+
+    for path in schema_paths:
+        module = parser.load(path, imports=import_roots)
+        _worker_modules[path] = module
+        _worker_registry[module.schema.node.id] = (path, module)
+
+
+def _generate_stubs_worker(path: str):
+    """Generate stubs for a single schema, using the registry of this worker process.
+
+    Args:
+        path (str): The path of the *.capnp schema to generate stubs for.
+    """
+    generate_stubs(
+        _worker_modules[path],
+        _worker_registry,
+        _output_file_path(path),
+        format_output=_worker_format_output,
+    )
+
+
+def _translate_glob_part(part: str) -> str:
+    """Translate a single glob pattern part (without path separators) into a regular expression.
+
+    Unlike `fnmatch.translate`, wildcards do not match across path separators.
+
+    Args:
+        part (str): The glob pattern part to translate.
+
+    Returns:
+        str: The regular expression for this part.
+    """
+    separator = re.escape(os.sep)
+    regex_parts: list[str] = []
+    index = 0
+
+    while index < len(part):
+        character = part[index]
+
+        if character == "*":
+            regex_parts.append(f"[^{separator}]*")
+
+        elif character == "?":
+            regex_parts.append(f"[^{separator}]")
+
+        elif character == "[":
+            closing_index = part.find("]", index + 2)
+
+            if closing_index < 0:
+                regex_parts.append(re.escape(character))
+
+            else:
+                character_set = part[index + 1 : closing_index].replace("\\", "\\\\")
+
+                if character_set.startswith("!"):
+                    character_set = "^" + character_set[1:]
+
+                regex_parts.append(f"[{character_set}]")
+                index = closing_index
+
+        else:
+            regex_parts.append(re.escape(character))
+
+        index += 1
+
+    return "".join(regex_parts)
+
+
+def _translate_glob(pattern: str, recursive: bool) -> str:
+    """Translate a full glob pattern into a regular expression for matching paths.
+
+    As with `glob`, wildcard parts do not match hidden names, while a literal part that starts
+    with a dot matches its hidden name exactly.
+
+    Args:
+        pattern (str): The glob pattern to translate.
+        recursive (bool): Whether `**` parts match any number of directories.
+
+    Returns:
+        str: The regular expression for this pattern.
+    """
+    separator = re.escape(os.sep)
+    # A wildcard part only matches hidden names when the part itself starts with a dot.
+    not_hidden = r"(?!\.)"
+    parts = pattern.split(os.sep)
+    regex = ""
+
+    for index, part in enumerate(parts):
+        is_last_part = index == len(parts) - 1
+
+        if recursive and part == "**":
+            component = f"{not_hidden}[^{separator}]+"
+
+            if is_last_part:
+                regex += f"{component}(?:{separator}{component})*"
+
+            else:
+                regex += f"(?:{component}{separator})*"
+
+        else:
+            part_regex = _translate_glob_part(part)
+
+            if glob.has_magic(part) and not part.startswith("."):
+                part_regex = not_hidden + part_regex
+
+            regex += part_regex + ("" if is_last_part else separator)
+
+    return regex + r"\Z"
+
+
+def _static_prefix(pattern: str) -> str:
+    """The leading directory part of a glob pattern that contains no glob metacharacters.
+
+    The final pattern part is the file name and is never included, even if it is a literal.
+
+    Args:
+        pattern (str): The glob pattern to extract the prefix from.
+
+    Returns:
+        str: The static directory prefix of the pattern.
+    """
+    parts = pattern.split(os.sep)
+    prefix_parts: list[str] = []
+
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+
+        prefix_parts.append(part)
+
+    prefix = os.sep.join(prefix_parts)
+
+    if prefix:
+        return prefix
+
+    # An absolute pattern with a wildcard in its first component starts at the filesystem root.
+    return os.sep if pattern.startswith(os.sep) else os.curdir
+
+
+def _match_paths(root_directory: str, pattern_groups: dict[str, list[str]], recursive: bool) -> dict[str, set[str]]:
+    """Match several groups of glob patterns against the file tree in a single walk.
+
+    Patterns without glob metacharacters are checked directly, without enumerating directories.
+    The remaining patterns are compiled into one matcher per group, and the tree below their common
+    static prefix is walked exactly once, classifying every file against all groups.
+
+    Args:
+        root_directory (str): The directory to which the patterns are relative.
+        pattern_groups (dict[str, list[str]]): Named groups of glob patterns to match against.
+        recursive (bool): Whether to match `**` patterns recursively.
+
+    Returns:
+        dict[str, set[str]]: The set of matching paths for each pattern group.
+    """
+    matches: dict[str, set[str]] = {group: set() for group in pattern_groups}
+    matchers: list[tuple[str, re.Pattern[str]]] = []
+    walk_roots: set[str] = set()
+    prune_hidden = True
+
+    for group, patterns in pattern_groups.items():
+        group_regexes: list[str] = []
+
+        for pattern in patterns:
+            full_pattern = os.path.join(root_directory, pattern)
+
+            if glob.has_magic(full_pattern):
+                group_regexes.append(_translate_glob(full_pattern, recursive))
+                walk_roots.add(_static_prefix(full_pattern))
+
+                # Hidden names are only matched by pattern parts that start with a dot themselves.
+                # As long as no pattern contains such a part, hidden directories can be pruned
+                # from the walk entirely.
+                if any(
+                    part.startswith(".") and part not in (os.curdir, os.pardir)
+                    for part in full_pattern.split(os.sep)
+                ):
+                    prune_hidden = False
+
+            elif os.path.lexists(full_pattern):
+                matches[group].add(full_pattern)
+
+        if group_regexes:
+            matchers.append((group, re.compile("|".join(group_regexes))))
+
+    if not matchers:
+        return matches
+
+    for directory, directory_names, file_names in os.walk(os.path.commonpath(walk_roots)):
+        if prune_hidden:
+            directory_names[:] = [name for name in directory_names if not name.startswith(".")]
+
+        for file_name in file_names:
+            if prune_hidden and file_name.startswith("."):
+                continue
+
+            file_path = os.path.join(directory, file_name)
+
+            for group, matcher in matchers:
+                if matcher.match(file_path):
+                    matches[group].add(file_path)
+
+    return matches
+
+
+@lru_cache(maxsize=None)
+def _output_file_path(path: str) -> str:
+    """The path of the output stub files for a schema, without file extension.
+
+    Args:
+        path (str): The path of the *.capnp schema.
+
+    Returns:
+        str: The output file path, without file extension.
+    """
+    pure_path = PurePath(path)
+    return str(pure_path.parent / replace_capnp_suffix(pure_path.name))
+
+
+# Matches the quoted file name of a capnp import statement, e.g. 'using Foo = import "foo.capnp";'.
+_IMPORT_PATTERN = re.compile(rb'\bimport\s+"([^"]+)"')
+
+
+@lru_cache(maxsize=None)
+def _schema_imports(path: str, import_roots: tuple[str, ...]) -> tuple[str, ...]:
+    """The paths of the schemas that a schema imports directly.
+
+    The imports are extracted with a textual scan, so that staleness can be checked without
+    parsing any schema. Absolute imports are resolved against the import roots, relative imports
+    against the directory of the importing schema. Imports that do not resolve to an existing
+    file (such as the capnp built-in schemas) are ignored.
+
+    Args:
+        path (str): The path of the *.capnp schema to scan.
+        import_roots (tuple[str, ...]): The directories against which absolute imports are resolved.
+
+    Returns:
+        tuple[str, ...]: The resolved paths of the directly imported schemas.
+    """
+    try:
+        with open(path, "rb") as schema_file:
+            content = schema_file.read()
+
+    except OSError:
+        return ()
+
+    imports: list[str] = []
+
+    for target in _IMPORT_PATTERN.findall(content):
+        target_name = target.decode("utf-8", errors="replace")
+
+        if target_name.startswith("/"):
+            candidates = (os.path.join(root, target_name.lstrip("/")) for root in import_roots)
+
+        else:
+            candidates = (os.path.join(os.path.dirname(path), target_name),)
+
+        for candidate in candidates:
+            candidate = os.path.normpath(candidate)
+
+            if os.path.isfile(candidate):
+                imports.append(candidate)
+                break
+
+    return tuple(imports)
+
+
+def _newest_source_mtime(path: str, import_roots: tuple[str, ...]) -> int:
+    """The newest modification time among a schema and its transitive imports.
+
+    Args:
+        path (str): The path of the *.capnp schema to check.
+        import_roots (tuple[str, ...]): The directories against which absolute imports are resolved.
+
+    Returns:
+        int: The newest modification time in nanoseconds.
+    """
+    newest_mtime = os.stat(path).st_mtime_ns
+    visited = {path}
+    pending = list(_schema_imports(path, import_roots))
+
+    while pending:
+        current = pending.pop()
+
+        if current in visited:
+            continue
+
+        visited.add(current)
+
+        try:
+            newest_mtime = max(newest_mtime, os.stat(current).st_mtime_ns)
+
+        except OSError:
+            continue
+
+        pending.extend(_schema_imports(current, import_roots))
+
+    return newest_mtime
+
+
+def _outputs_up_to_date(path: str, import_roots: tuple[str, ...]) -> bool:
+    """Check, whether the stub outputs of a schema are newer than the schema and its imports.
+
+    A schema's stubs depend on the definitions of every schema it imports, transitively, so an
+    output is only considered current when it is newer than the whole import closure.
+
+    Args:
+        path (str): The path of the *.capnp schema to check.
+        import_roots (tuple[str, ...]): The directories against which absolute imports are resolved.
+
+    Returns:
+        bool: True, if both stub outputs exist and are newer than all source schemas, False otherwise.
+    """
+    output_file_path = _output_file_path(path)
+
+    try:
+        source_mtime = _newest_source_mtime(path, import_roots)
+        return all(
+            os.stat(output_file_path + suffix).st_mtime_ns > source_mtime for suffix in (PYI_SUFFIX, PY_SUFFIX)
+        )
+
+    except OSError:
+        return False
+
+
 def run(args: argparse.Namespace, root_directory: str):
     """Run the stub generator on a set of paths that point to *.capnp schemas.
 
@@ -77,36 +456,43 @@ def run(args: argparse.Namespace, root_directory: str):
     excludes: list[str] = args.excludes
     clean: list[str] = args.clean
 
-    cleanup_paths: set[str] = set()
-    for c in clean:
-        cleanup_directory = os.path.join(root_directory, c)
-        cleanup_paths = cleanup_paths.union(glob.glob(cleanup_directory, recursive=args.recursive))
+    matches = _match_paths(root_directory, {"clean": clean, "excludes": excludes, "paths": paths}, args.recursive)
 
+    cleanup_paths = matches["clean"]
     for cleanup_path in cleanup_paths:
         os.remove(cleanup_path)
 
-    excluded_paths: set[str] = set()
-    for exclude in excludes:
-        exclude_directory = os.path.join(root_directory, exclude)
-        excluded_paths = excluded_paths.union(glob.glob(exclude_directory, recursive=args.recursive))
+    excluded_paths = matches["excludes"]
+    excluded_paths -= cleanup_paths
 
-    search_paths: set[str] = set()
-    for path in paths:
-        search_directory = os.path.join(root_directory, path)
-        search_paths = search_paths.union(glob.glob(search_directory, recursive=args.recursive))
+    search_paths = matches["paths"]
+    search_paths -= cleanup_paths
 
     # The `valid_paths` contain the automatically detected search paths, except for specifically excluded paths.
     valid_paths = search_paths - excluded_paths
 
-    parser = capnp.SchemaParser()
-    module_registry: ModuleRegistryType = {}
+    if not valid_paths:
+        return
+
+    # Stub generation is CPU-bound and independent per module, so distribute the modules across processes.
+    schema_paths = sorted(valid_paths)
 
-    for path in valid_paths:
-        module = parser.load(path)
-        module_registry[module.schema.node.id] = (path, module)
+    # Skip schemas whose outputs are already newer than the schema and all of its imports. The
+    # workers still load all schemas, as an outdated schema may import a skipped one. The largest
+    # schemas are submitted first, so the longest generation jobs do not end up at the tail of the pool.
+    import_roots = tuple(sorted({os.path.dirname(path) for path in schema_paths}))
+    outdated_paths = sorted(
+        (path for path in schema_paths if not _outputs_up_to_date(path, import_roots)),
+        key=os.path.getsize,
+        reverse=True,
+    )
 
-    for path, module in module_registry.values():
-        output_directory = os.path.dirname(path)
-        output_file_name = replace_capnp_suffix(os.path.basename(path))
+    if not outdated_paths:
+        logger.info("All stubs are up-to-date.")
+        return
 
-        generate_stubs(module, module_registry, os.path.join(output_directory, output_file_name))
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(), initializer=_init_worker, initargs=(schema_paths, args.format)
+    ) as executor:
+        for _ in executor.map(_generate_stubs_worker, outdated_paths):
+            pass
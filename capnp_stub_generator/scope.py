@@ -1,8 +1,9 @@
 """This module defines the scope, a unit of indented text."""
 from __future__ import annotations
 
-import dataclasses
 import logging
+from collections.abc import Iterable
+from collections.abc import Iterator
 from typing import Any
 from typing import Literal
 
@@ -12,34 +13,100 @@ logger = logging.getLogger(__name__)
 
 INDENT_SPACES = 4
 
+# A line fragment is either a single rendered line, or the nested fragment list of a child scope
+# that was merged into its parent. Nesting keeps scope merges O(1); the fragments are flattened
+# back into plain lines once, at output time.
+LineFragment = Any
+
+
+def _flatten_fragments(fragments: list[LineFragment]) -> Iterator[str]:
+    """Yield all lines from a fragment list, descending into nested fragment lists in order.
+
+    Args:
+        fragments (list[LineFragment]): The fragments to flatten.
+
+    Yields:
+        str: The rendered lines, in emission order.
+    """
+    for fragment in fragments:
+        if isinstance(fragment, list):
+            yield from _flatten_fragments(fragment)
+
+        else:
+            yield fragment
+
 
 class NoParentError(Exception):
     """Raised, when the parent of a scope is not available."""
 
 
-@dataclasses.dataclass
 class Scope:
     """A scope within the output .pyi file.
 
     Scopes contain text and are indented by a certain amount. They often have parents, within which they are located.
 
+    Scopes are created in large numbers and their attributes are accessed constantly, so this is a
+    plain `__slots__` class rather than a dataclass. The parents of a scope never change after
+    construction, so the parent chain and everything derived from it is computed once in the
+    constructor, instead of re-walking the chain on every access.
+
     Args:
         name (str): The name of the scope. Use an empty name for the root scope ("").
         id (int): A numerical identifier of the scope.
         parent (Scope | None): The direct parent scope of this scope, if there is any.
-        return scope (Scope | None): The scope to which to return, when closing this one.
-        lines (list[str]): The list of text lines in this scope.
+        return_scope (Scope | None): The scope to which to return, when closing this one.
+        lines (list[LineFragment] | None): The list of line fragments in this scope. Optional, defaults to None.
+        type (str): The kind of element that opened this scope. Optional, defaults to "struct".
     """
 
-    name: str
-    id: int
-    parent: Scope | None
-    return_scope: Scope | None
-    lines: list[str] = dataclasses.field(default_factory=list)
-    type: str = "struct"
+    __slots__ = (
+        "name",
+        "id",
+        "parent",
+        "return_scope",
+        "lines",
+        "type",
+        "_parents",
+        "_indent_prefix",
+        "_trace_dot",
+        "_trace_underscore",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        id: int,
+        parent: Scope | None,
+        return_scope: Scope | None,
+        lines: list[LineFragment] | None = None,
+        type: str = "struct",
+    ):
+        """Initialize the scope and cache its parent chain and indent prefix."""
+        self.name = name
+        self.id = id
+        self.parent = parent
+        self.return_scope = return_scope
+        self.lines: list[LineFragment] = lines if lines is not None else []
+        self.type = type
+
+        if parent is None:
+            self._parents: list[Scope] = []
+
+        else:
+            self._parents = parent._parents + [parent]
+
+        self._indent_prefix = " " * (len(self._parents) * INDENT_SPACES)
+
+        # The trace strings are cached here, as they are rebuilt for every type-name lookup
+        # otherwise. Root scopes have an empty name, so filtering on the name is equivalent to
+        # excluding the root scope from the trace.
+        trace_names = [scope.name for scope in self._parents if scope.name]
+        if name:
+            trace_names.append(name)
+
+        self._trace_dot = ".".join(trace_names)
+        self._trace_underscore = "_".join(trace_names)
 
-    def __post_init__(self):
-        """Assures that, if this is the root scope, its name is empty."""
         assert (self.is_root) == (self.name == "")
 
     @property
@@ -49,16 +116,7 @@ class Scope:
         If the returned list is empty, this scope has no parents. The first parent in the list has no further
         parents, it is the root scope.
         """
-        parents: list[Scope] = []
-        scope: Scope | None = self.parent
-
-        while scope is not None:
-            parents.append(scope)
-            scope = scope.parent
-
-        parents.reverse()
-
-        return parents
+        return self._parents
 
     @property
     def trace(self) -> list[Scope]:
@@ -66,26 +124,26 @@ class Scope:
 
         The first parent has no further parents.
         """
-        return self.parents + [self]
+        return self._parents + [self]
 
     @property
     def root(self) -> Scope:
         """Get the root scope that has no further parents."""
-        if not self.parents:
+        if not self._parents:
             return self
 
         else:
-            return self.parents[0]
+            return self._parents[0]
 
     @property
     def is_root(self) -> bool:
         """Determine, whether this is the root scope."""
-        return self.root == self
+        return self.parent is None
 
     @property
     def indent_spaces(self) -> int:
         """The number of spaces by which this scope is indented."""
-        return len(self.parents) * INDENT_SPACES
+        return len(self._parents) * INDENT_SPACES
 
     def add(self, content: str | TypeHintedVariable = ""):
         """Add content to this scope, taking into account the current indent spaces.
@@ -93,14 +151,43 @@ class Scope:
         Args:
             content (str | HintedVariable): The line or variable to add. Optional, defaults to "".
         """
-        if isinstance(content, TypeHintedVariable):
-            content = str(content)
+        self.add_lines((content,))
 
-        if not content:
-            self.lines.append("")
+    def add_lines(self, contents: Iterable[str | TypeHintedVariable]):
+        """Add multiple pieces of content to this scope in a single batch.
 
-        else:
-            self.lines.append(" " * self.indent_spaces + content)
+        Batching avoids the per-call overhead of `add` when whole blocks of lines are emitted.
+
+        Args:
+            contents (Iterable[str | TypeHintedVariable]): The lines or variables to add.
+        """
+        prefix = self._indent_prefix
+        lines: list[str] = []
+
+        for content in contents:
+            if isinstance(content, TypeHintedVariable):
+                content = str(content)
+
+            if not content:
+                lines.append("")
+
+            # A subscripted type that is followed by a Builder/Reader affix is not valid syntax.
+            # Emit such lines as comments right away, instead of patching them up in a later pass.
+            elif content.endswith(("]Builder", "]Reader")):
+                lines.append(prefix + "# " + content)
+
+            else:
+                lines.append(prefix + content)
+
+        self.lines.extend(lines)
+
+    def flattened_lines(self) -> Iterator[str]:
+        """Iterate over all lines of this scope, including those of merged child scopes, in order.
+
+        Yields:
+            str: The rendered lines of this scope.
+        """
+        return _flatten_fragments(self.lines)
 
     def trace_as_str(self, delimiter: Literal[".", "_"] = ".") -> str:
         """A string representation of this scope's relative trace.
@@ -111,17 +198,16 @@ class Scope:
         Args:
             delimiter (Literal[".", "_"]): The delimiter to join the scope names with.
         """
-        return delimiter.join(scope.name for scope in self.trace if (not scope.is_root) and (scope.name))
+        return self._trace_dot if delimiter == "." else self._trace_underscore
 
     def __repr__(self) -> str:
         """A string representation of this scope.
 
         Follow the path of scopes, and connect parent scopes with '.'.
         """
-        return self.trace_as_str(".")
+        return self._trace_dot
 
 
-@dataclasses.dataclass
 class CapnpType:
     """Represents a type that is extracted from a .capnp schema.
 
@@ -129,13 +215,17 @@ class CapnpType:
         schema (Any):
         name (str):
         scope (Scope):
-        generic_params (list[str]):
+        generic_params (list[str] | None):
     """
 
-    schema: Any
-    name: str
-    scope: Scope
-    generic_params: list[str] = dataclasses.field(default_factory=list)
+    __slots__ = ("schema", "name", "scope", "generic_params")
+
+    def __init__(self, schema: Any, name: str, scope: Scope, generic_params: list[str] | None = None):
+        """Initialize the type representation."""
+        self.schema = schema
+        self.name = name
+        self.scope = scope
+        self.generic_params: list[str] = generic_params if generic_params is not None else []
 
     @property
     def scoped_name(self) -> str:
@@ -6,12 +6,15 @@ Note: capnp interfaces (RPC) are not yet supported.
 """
 from __future__ import annotations
 
+import io
 import logging
 import os.path
 import pathlib
+import sys
 from types import ModuleType
 from typing import Any
 from typing import Literal
+from typing import TextIO
 from typing import Tuple
 
 import capnp  # type: ignore
@@ -27,6 +30,70 @@ logger = logging.getLogger(__name__)
 
 InitChoice = Tuple[str, str]
 
+# The element and field kinds that are compared against for every field are bound once at module
+# level, so the hot loops load a single global instead of going through two attribute lookups.
+_ELEMENT_STRUCT = capnp_types.CapnpElementType.STRUCT
+_ELEMENT_ENUM = capnp_types.CapnpElementType.ENUM
+_ELEMENT_LIST = capnp_types.CapnpElementType.LIST
+_FIELD_SLOT = capnp_types.CapnpFieldType.SLOT
+_FIELD_GROUP = capnp_types.CapnpFieldType.GROUP
+
+
+def _capitalize_first(name: str) -> str:
+    """Capitalize the first character of a name, leaving the rest of it untouched.
+
+    Args:
+        name (str): The name to capitalize.
+
+    Returns:
+        str: The name with its first character in upper case.
+    """
+    return name[:1].upper() + name[1:]
+
+
+def _schema_elements(schema: capnp.lib.capnp._ListSchema) -> capnp.lib.capnp._ListSchema:
+    """An iterator over the schema elements of nested lists.
+
+    Args:
+        schema (capnp.lib.capnp._ListSchema): The schema of a list.
+
+    Returns:
+        capnp.lib.capnp._ListSchema: The next deeper nested list schema.
+    """
+    next_schema_element = schema
+
+    while True:
+        try:
+            next_schema_element = next_schema_element.elementType
+
+        except (AttributeError, capnp.KjException):
+            break
+
+        else:
+            yield next_schema_element
+
+
+def _list_elements(list_: capnp.lib.capnp._DynamicStructReader) -> capnp.lib.capnp._DynamicStructReader:
+    """An iterator over the list elements of nested lists.
+
+    Args:
+        list_ (capnp.lib.capnp._DynamicStructReader): A list element.
+
+    Returns:
+        capnp.lib.capnp._DynamicStructReader: The next deeper nested list element.
+    """
+    next_list_element = list_
+
+    while True:
+        try:
+            next_list_element = next_list_element.list.elementType
+
+        except (AttributeError, capnp.KjException):
+            break
+
+        else:
+            yield next_list_element
+
 
 class Writer:
     """A class that handles writing the stub file, based on a provided module definition."""
@@ -46,20 +113,50 @@ class Writer:
         self._module = module
         self._module_registry = module_registry
 
+        # Reverse index from nested node ID to the defining module's path, built once so that
+        # import lookups do not have to re-scan every module in the registry.
+        self._node_owner_paths: dict[int, pathlib.Path] = {
+            node.id: pathlib.Path(path)
+            for path, registered_module in module_registry.values()
+            for node in registered_module.schema.node.nestedNodes
+        }
+
         if self._module.__file__:
             self._module_path = pathlib.Path(self._module.__file__)
 
         else:
             raise ValueError("The module has no file path attached to it.")
 
-        self._imports: set[str] = set()
+        # Plain dicts are used as ordered sets here: deduplication stays O(1), while iteration
+        # follows insertion order, which keeps the emitted imports deterministic without sorting.
+        self._imports: dict[str, None] = {}
         self._add_import("from __future__ import annotations")
 
-        self._typing_imports: set[Writer.VALID_TYPING_IMPORTS] = set()
+        self._typing_imports: dict[Writer.VALID_TYPING_IMPORTS, None] = {}
 
         self.type_vars: set[str] = set()
         self.type_map: dict[int, CapnpType] = {}
 
+        # Caches the resolved Python import path per imported schema node, see `register_import`.
+        self._import_path_cache: dict[int, str] = {}
+
+        # Caches resolved type names per schema node, see `get_type_name`.
+        self._type_name_cache: dict[tuple[str, int], str] = {}
+
+        # Caches display names and displayName splits per schema node, as both are recomputed
+        # from pycapnp string attributes for every reference to the same schema otherwise.
+        self._display_name_cache: dict[int, str] = {}
+        self._display_name_split_cache: dict[int, tuple[str, str]] = {}
+
+        # Dispatch table for `gen_slot`, built once so that handling a field is a single dict
+        # lookup instead of an if/elif chain of attribute lookups.
+        self._slot_dispatch = {
+            capnp_types.CapnpElementType.LIST: self.gen_list_slot,
+            capnp_types.CapnpElementType.ENUM: self.gen_enum_slot,
+            capnp_types.CapnpElementType.STRUCT: self.gen_struct_slot,
+            capnp_types.CapnpElementType.ANY_POINTER: self.gen_any_pointer_slot,
+        }
+
         self.docstring = f'"""This is an automatically generated stub for `{self._module_path.name}`."""'
 
     def _add_typing_import(self, module_name: Writer.VALID_TYPING_IMPORTS):
@@ -74,7 +171,7 @@ class Writer:
         Args:
             module_name (Writer.VALID_TYPING_IMPORTS): The module to import from `typing`.
         """
-        self._typing_imports.add(module_name)
+        self._typing_imports[module_name] = None
 
     def _add_import(self, import_line: str):
         """Add a full import line.
@@ -84,12 +181,47 @@ class Writer:
         Args:
             import_line (str): The import line to add.
         """
-        self._imports.add(import_line)
+        self._imports[import_line] = None
 
     def _add_enum_import(self):
         """Adds an import for the `Enum` class."""
         self._add_import("from enum import Enum")
 
+    def _get_display_name(self, schema: Any) -> str:
+        """Extract the display name from a schema, caching the result per schema node.
+
+        Args:
+            schema (Any): The schema to get the display name from.
+
+        Returns:
+            str: The display name of the schema.
+        """
+        node_id = schema.node.id
+        display_name = self._display_name_cache.get(node_id)
+
+        if display_name is None:
+            self._display_name_cache[node_id] = display_name = helper.get_display_name(schema)
+
+        return display_name
+
+    def _split_display_name(self, schema: Any) -> tuple[str, str]:
+        """Split a schema's display name into its module and definition names, cached per schema node.
+
+        Args:
+            schema (Any): The schema to split the display name of.
+
+        Returns:
+            tuple[str, str]: The module name and the definition name.
+        """
+        node_id = schema.node.id
+        split_name = self._display_name_split_cache.get(node_id)
+
+        if split_name is None:
+            module_name, definition_name = schema.node.displayName.split(":")
+            self._display_name_split_cache[node_id] = split_name = (module_name, definition_name)
+
+        return split_name
+
     @property
     def full_display_name(self) -> str:
         """The base name of this writer's target module."""
@@ -107,13 +239,10 @@ class Writer:
         Returns:
             list[str]: The list of imports that were previously added.
         """
-        import_lines: list[str] = []
-
-        for imp in self._imports:
-            import_lines.append(imp)
+        import_lines: list[str] = list(self._imports)
 
         if self._typing_imports:
-            import_lines.append("from typing import " + ", ".join(sorted(self._typing_imports)))
+            import_lines.append("from typing import " + ", ".join(self._typing_imports))
 
         return import_lines
 
@@ -136,96 +265,45 @@ class Writer:
         Returns:
             helper.TypeHintedVariable | None: The type hinted variable that was created, or None otherwise.
         """
-        hinted_variable: helper.TypeHintedVariable | None
-        field_slot_type = field.slot.type.which()
+        field_slot_type = sys.intern(field.slot.type.which())
 
-        if field_slot_type == capnp_types.CapnpElementType.LIST:
-            hinted_variable = self.gen_list_slot(field, raw_field.schema)
+        handler = self._slot_dispatch.get(field_slot_type)
 
-        elif field_slot_type in capnp_types.CAPNP_TYPE_TO_PYTHON:
-            hinted_variable = self.gen_python_type_slot(field, field_slot_type)
+        if handler is not None:
+            return handler(raw_field, field, new_type, init_choices)
 
-        elif field_slot_type == capnp_types.CapnpElementType.ENUM:
-            hinted_variable = self.gen_enum_slot(field, raw_field.schema)
+        if field_slot_type in capnp_types.CAPNP_TYPE_TO_PYTHON:
+            return self.gen_python_type_slot(field, field_slot_type)
 
-        elif field_slot_type == capnp_types.CapnpElementType.STRUCT:
-            hinted_variable = self.gen_struct_slot(field, raw_field.schema, init_choices)
-            hinted_variable.add_builder_from_primary_type()
-            hinted_variable.add_reader_from_primary_type()
-
-        elif field_slot_type == capnp_types.CapnpElementType.ANY_POINTER:
-            hinted_variable = self.gen_any_pointer_slot(field, new_type)
-
-        else:
-            raise TypeError(f"Unknown field slot type {field_slot_type}.")
-
-        return hinted_variable
+        raise TypeError(f"Unknown field slot type {field_slot_type}.")
 
     def gen_list_slot(
-        self, field: capnp.lib.capnp._DynamicStructReader, schema: capnp.lib.capnp._ListSchema
+        self, raw_field: Any, field: capnp.lib.capnp._DynamicStructReader, new_type: CapnpType, init_choices: list[InitChoice]
     ) -> helper.TypeHintedVariable:
         """Generate a slot, which contains a `list`.
 
         Args:
+            raw_field (Any): The raw content of the field.
             field (capnp.lib.capnp._DynamicStructReader): The field reader.
-            schema (capnp.lib.capnp._ListSchema): The schema of the list.
+            new_type (CapnpType): The new type that was registered previously. Unused here.
+            init_choices (list[InitChoice]): A list of overloaded `init` function choices. Unused here.
 
         Returns:
             helper.TypeHintedVariable: The extracted hinted variable object.
         """
-
-        def schema_elements(schema: capnp.lib.capnp._ListSchema) -> capnp.lib.capnp._ListSchema:
-            """An iterator over the schema elements of nested lists.
-
-            Args:
-                schema (capnp.lib.capnp._ListSchema): The schema of a list.
-
-            Returns:
-                capnp.lib.capnp._ListSchema: The next deeper nested list schema.
-            """
-            next_schema_element = schema
-
-            while True:
-                try:
-                    next_schema_element = next_schema_element.elementType
-
-                except (AttributeError, capnp.KjException):
-                    break
-
-                else:
-                    yield next_schema_element
-
-        def list_elements(list_: capnp.lib.capnp._DynamicStructReader) -> capnp.lib.capnp._DynamicStructReader:
-            """An iterator over the list elements of nested lists.
-
-            Args:
-                list_ (capnp.lib.capnp._DynamicStructReader): A list element.
-
-            Returns:
-                capnp.lib.capnp._DynamicStructReader: The next deeper nested list element.
-            """
-            next_list_element = list_
-
-            while True:
-                try:
-                    next_list_element = next_list_element.list.elementType
-
-                except (AttributeError, capnp.KjException):
-                    break
-
-                else:
-                    yield next_list_element
+        schema: capnp.lib.capnp._ListSchema = raw_field.schema
+        slot_type = field.slot.type
 
         list_depth: int = 1
-        nested_schema_elements = list(schema_elements(schema))
-        nested_list_elements = list(list_elements(field.slot.type))
+        nested_schema_elements = list(_schema_elements(schema))
+        nested_list_elements = list(_list_elements(slot_type))
 
         create_extended_types = True
 
         try:
             last_element = nested_schema_elements[-1]
 
-            self.generate_nested(last_element)
+            self._ensure_type(last_element)
             list_depth = len(nested_schema_elements)
             new_type = self.get_type_by_id(last_element.node.id)
             type_name = new_type.scoped_name
@@ -236,7 +314,7 @@ class Writer:
             last_element = nested_list_elements[-1]
 
             try:
-                self.generate_nested(last_element)
+                self._ensure_type(last_element)
 
             except AttributeError:
                 # This is a built-in type and does not require generation.
@@ -244,7 +322,7 @@ class Writer:
                 type_name = self.get_type_name(last_element)
 
             else:
-                type_name = self.get_type_name(field.slot.type.list.elementType)
+                type_name = self.get_type_name(slot_type.list.elementType)
 
             list_depth = len(nested_list_elements)
 
@@ -275,57 +353,73 @@ class Writer:
         python_type_name: str = capnp_types.CAPNP_TYPE_TO_PYTHON[field_type]
         return helper.TypeHintedVariable(field.name, [helper.TypeHint(python_type_name, primary=True)])
 
-    def gen_enum_slot(self, field: capnp.lib.capnp._DynamicStructReader, schema) -> helper.TypeHintedVariable:
+    def gen_enum_slot(
+        self, raw_field: Any, field: capnp.lib.capnp._DynamicStructReader, new_type: CapnpType, init_choices: list[InitChoice]
+    ) -> helper.TypeHintedVariable:
         """Generate a slot, which contains a `enum`.
 
         Args:
+            raw_field (Any): The raw content of the field.
             field (capnp.lib.capnp._DynamicStructReader): The field reader.
-            schema (capnp.lib.capnp._StructSchema): The schema of the field.
+            new_type (CapnpType): The new type that was registered previously. Unused here.
+            init_choices (list[InitChoice]): A list of overloaded `init` function choices. Unused here.
 
         Returns:
             str: The type-hinted slot.
         """
-        if not self.is_type_id_known(field.slot.type.enum.typeId):
-            try:
-                self.generate_nested(schema)
+        schema = raw_field.schema
+        slot_type = field.slot.type
 
-            except NoParentError:
-                pass
+        try:
+            self._ensure_type(schema)
 
-        type_name = self.get_type_name(field.slot.type)
+        except NoParentError:
+            pass
+
+        type_name = self.get_type_name(slot_type)
         return helper.TypeHintedVariable(field.name, [helper.TypeHint(type_name, primary=True)])
 
     def gen_struct_slot(
         self,
+        raw_field: Any,
         field: capnp.lib.capnp._DynamicStructReader,
-        schema: capnp.lib.capnp._StructSchema,
+        new_type: CapnpType,
         init_choices: list[InitChoice],
     ) -> helper.TypeHintedVariable:
         """Generate a slot, which contains a `struct`.
 
         Args:
+            raw_field (Any): The raw content of the field.
             field (capnp.lib.capnp._DynamicStructReader): The field reader.
-            schema (capnp.lib.capnp._StructSchema): The schema of the field.
+            new_type (CapnpType): The new type that was registered previously. Unused here.
             init_choices (list[InitChoice]): A list of overloaded `init` function choices, to be filled by this function.
 
         Returns:
             helper.HintedVariable: The extracted hinted variable object.
         """
-        if not self.is_type_id_known(schema.node.id):
-            self.gen_struct(schema)
+        schema: capnp.lib.capnp._StructSchema = raw_field.schema
+
+        self._ensure_type(schema)
 
         type_name = self.get_type_name(field.slot.type)
         init_choices.append((field.name, type_name))
-        return helper.TypeHintedVariable(field.name, [helper.TypeHint(type_name, primary=True)])
+
+        hinted_variable = helper.TypeHintedVariable(field.name, [helper.TypeHint(type_name, primary=True)])
+        hinted_variable.add_builder_from_primary_type()
+        hinted_variable.add_reader_from_primary_type()
+
+        return hinted_variable
 
     def gen_any_pointer_slot(
-        self, field: capnp.lib.capnp._DynamicStructReader, new_type: CapnpType
+        self, raw_field: Any, field: capnp.lib.capnp._DynamicStructReader, new_type: CapnpType, init_choices: list[InitChoice]
     ) -> helper.TypeHintedVariable | None:
         """Generate a slot, which contains an `any_pointer` object.
 
         Args:
+            raw_field (Any): The raw content of the field. Unused here.
             field (capnp.lib.capnp._DynamicStructReader): The field reader.
             new_type (CapnpType): The new type that was registered previously.
+            init_choices (list[InitChoice]): A list of overloaded `init` function choices. Unused here.
 
         Returns:
             helper.HintedVariable | None: The extracted hinted variable object, or None in case of error.
@@ -344,13 +438,14 @@ class Writer:
         Args:
             schema (capnp.lib.capnp._StructSchema): The schema to generate the `const` object out of.
         """
-        assert schema.node.which() == capnp_types.CapnpElementType.CONST
+        node = schema.node
+        assert node.which() == capnp_types.CapnpElementType.CONST
 
-        const_type = schema.node.const.type.which()
-        name = helper.get_display_name(schema)
+        const_type = node.const.type.which()
+        name = self._get_display_name(schema)
 
         if const_type in capnp_types.CAPNP_TYPE_TO_PYTHON:
-            python_type = capnp_types.CAPNP_TYPE_TO_PYTHON[schema.node.const.type.which()]
+            python_type = capnp_types.CAPNP_TYPE_TO_PYTHON[const_type]
             self.scope.add(helper.TypeHintedVariable(name, [helper.TypeHint(python_type, primary=True)]))
 
         elif const_type == "struct":
@@ -364,28 +459,32 @@ class Writer:
         Args:
             schema (capnp.lib.capnp._StructSchema): The schema to generate the `enum` object out of.
         """
-        assert schema.node.which() == capnp_types.CapnpElementType.ENUM
+        node = schema.node
+        assert node.which() == capnp_types.CapnpElementType.ENUM
 
         imported = self.register_import(schema)
 
         if imported is not None:
             return imported
 
-        name = helper.get_display_name(schema)
-        self.register_type(schema.node.id, schema, name=name, scope=self.scope)
+        node_id = node.id
+        name = self._get_display_name(schema)
+        self.register_type(node_id, schema, name=name, scope=self.scope)
 
         self._add_typing_import("Literal")
-        enum_type = helper.new_group("Literal", [f'"{enumerant.name}"' for enumerant in schema.node.enum.enumerants])
+        enum_type = helper.new_group("Literal", [f'"{enumerant.name}"' for enumerant in node.enum.enumerants])
         self.scope.add(helper.new_type_alias(name, enum_type))
-        self.scopes_by_id[schema.node.id] = Scope(name=name, id=schema.node.id, parent=self.scope, return_scope=self.scope, type="enum")
+        self.scopes_by_id[node_id] = Scope(name=name, id=node_id, parent=self.scope, return_scope=self.scope, type="enum")
 
         return None
 
-    def gen_generic(self, schema: capnp.lib.capnp._StructSchema) -> list[str]:
+    def gen_generic(self, schema: capnp.lib.capnp._StructSchema, field_pairs: list[tuple[Any, Any]]) -> list[str]:
         """Generate a `generic` type variable.
 
         Args:
             schema (capnp.lib.capnp._StructSchema): The schema to generate the `generic` object out of.
+            field_pairs (list[tuple[Any, Any]]): The field and raw-field pairs of the schema,
+                pre-materialized by the caller.
 
         Returns:
             list[str]: The list of registered generic type variables.
@@ -393,12 +492,15 @@ class Writer:
         self._add_typing_import("TypeVar")
         self._add_typing_import("Generic")
 
-        generic_params: list[str] = [param.name for param in schema.node.parameters]
+        node = schema.node
+        generic_params: list[str] = [param.name for param in node.parameters]
         referenced_params: list[str] = []
 
-        for field, _ in zip(schema.node.struct.fields, schema.as_struct().fields_list):
-            if field.slot.type.which() == "anyPointer" and field.slot.type.anyPointer.which() == "parameter":
-                param = field.slot.type.anyPointer.parameter
+        for field, _ in field_pairs:
+            slot_type = field.slot.type
+
+            if slot_type.which() == "anyPointer" and slot_type.anyPointer.which() == "parameter":
+                param = slot_type.anyPointer.parameter
 
                 t = self.get_type_by_id(param.scopeId)
 
@@ -407,7 +509,10 @@ class Writer:
                     source_params: list[str] = [param.name for param in param_source.node.parameters]
                     referenced_params.append(source_params[param.parameterIndex])
 
-        return [self.register_type_var(param) for param in generic_params + referenced_params]
+        registered_params = [self.register_type_var(param) for param in generic_params]
+        registered_params.extend(self.register_type_var(param) for param in referenced_params)
+
+        return registered_params
 
     # FIXME: refactor for reducing complexity
     def gen_struct(self, schema: capnp.lib.capnp._StructSchema, type_name: str = "") -> CapnpType:  # noqa: C901
@@ -420,7 +525,8 @@ class Writer:
         Returns:
             Type: The `struct`-type module that was generated.
         """
-        assert schema.node.which() == capnp_types.CapnpElementType.STRUCT
+        node = schema.node
+        assert node.which() == capnp_types.CapnpElementType.STRUCT
 
         imported = self.register_import(schema)
 
@@ -428,11 +534,16 @@ class Writer:
             return imported
 
         if not type_name:
-            type_name = helper.get_display_name(schema)
+            type_name = self._get_display_name(schema)
+
+        # Materialize the field pairs once; they are re-used for the generic parameters, the slot
+        # loop and the union discriminants, so `as_struct()` only crosses into pycapnp a single time.
+        struct_node = node.struct
+        field_pairs = list(zip(struct_node.fields, schema.as_struct().fields_list))
 
         registered_params: list[str] = []
-        if schema.node.isGeneric:
-            registered_params = self.gen_generic(schema)
+        if node.isGeneric:
+            registered_params = self.gen_generic(schema, field_pairs)
 
         class_declaration: str
         if registered_params:
@@ -443,9 +554,9 @@ class Writer:
             class_declaration = helper.new_class_declaration(type_name)
 
         # Do not write the class declaration to the scope, until all nested schemas were expanded.
-        parent_scope = self.new_scope(type_name, schema.node)
+        parent_scope = self.new_scope(type_name, node)
 
-        new_type: CapnpType = self.register_type(schema.node.id, schema, name=type_name)
+        new_type: CapnpType = self.register_type(node.id, schema, name=type_name)
         new_type.generic_params = registered_params
 
         new_builder_type_name = helper.new_builder(new_type.name)
@@ -456,17 +567,17 @@ class Writer:
         init_choices: list[InitChoice] = []
         slot_fields: list[helper.TypeHintedVariable] = []
 
-        for field, raw_field in zip(schema.node.struct.fields, schema.as_struct().fields_list):
+        for field, raw_field in field_pairs:
             field_type = field.which()
 
-            if field_type == capnp_types.CapnpFieldType.SLOT:
+            if field_type == _FIELD_SLOT:
                 slot_field = self.gen_slot(raw_field, field, new_type, init_choices)
 
                 if slot_field is not None:
                     slot_fields.append(slot_field)
 
-            elif field_type == capnp_types.CapnpFieldType.GROUP:
-                group_name = field.name[0].upper() + field.name[1:]
+            elif field_type == _FIELD_GROUP:
+                group_name = _capitalize_first(field.name)
 
                 assert group_name != field.name
 
@@ -483,20 +594,19 @@ class Writer:
                 init_choices.append((field.name, group_name))
 
             else:
-                raise AssertionError(f"{schema.node.displayName}: {field.name}: " f"{field.which()}")
+                raise AssertionError(f"{node.displayName}: {field.name}: " f"{field.which()}")
 
         # Finally, add the class declaration after the expansion of all nested schemas.
         parent_scope.add(class_declaration)
 
         # Add the slot fields, if any.
         if slot_fields:
-            for slot_field in slot_fields:
-                self.scope.add(slot_field.typed_variable_with_full_hints)
+            self.scope.add_lines(slot_field.typed_variable_with_full_hints for slot_field in slot_fields)
 
         # Add the `which` function, if there is a top-level union in the schema.
-        if schema.node.struct.discriminantCount:
+        if struct_node.discriminantCount:
             self._add_typing_import("Literal")
-            field_names = [f'"{field.name}"' for field in schema.node.struct.fields if field.discriminantValue != 65535]
+            field_names = [f'"{field.name}"' for field, _ in field_pairs if field.discriminantValue != 65535]
             return_type = helper.new_type_group("Literal", field_names)
 
             self.scope.add(helper.new_function("which", parameters=["self"], return_type=return_type))
@@ -570,12 +680,14 @@ class Writer:
         self.return_from_scope()
 
         # Generate the reader class
-        parent_scope = self.new_scope(new_reader_type_name, schema.node, register=False)
+        parent_scope = self.new_scope(new_reader_type_name, node, register=False)
 
         # Add the reader slot fields, if any.
-        for slot_field in slot_fields:
-            if slot_field.has_type_hint_with_reader_affix:
-                self.scope.add(slot_field.get_typed_variable_with_affixes([helper.READER_NAME]))
+        self.scope.add_lines(
+            slot_field.get_typed_variable_with_affixes([helper.READER_NAME])
+            for slot_field in slot_fields
+            if slot_field.has_type_hint_with_reader_affix
+        )
 
         reader_class_declaration = helper.new_class_declaration(new_reader_type_name, parameters=[new_type.scoped_name])
         parent_scope.add(reader_class_declaration)
@@ -584,14 +696,14 @@ class Writer:
         self.return_from_scope()
 
         # Generate the builder class
-        parent_scope = self.new_scope(new_builder_type_name, schema.node, register=False)
+        parent_scope = self.new_scope(new_builder_type_name, node, register=False)
 
         # Add the builder slot fields, if any.
-        for slot_field in slot_fields:
-            if slot_field.has_type_hint_with_builder_affix:
-                self.scope.add(
-                    slot_field.typed_variable_with_full_hints
-                )  # .get_typed_variable_with_affixes([helper.BUILDER_NAME, helper.READER_NAME]))
+        self.scope.add_lines(
+            slot_field.typed_variable_with_full_hints  # .get_typed_variable_with_affixes([helper.BUILDER_NAME, helper.READER_NAME])
+            for slot_field in slot_fields
+            if slot_field.has_type_hint_with_builder_affix
+        )
 
         self.scope.add(helper.new_decorator("staticmethod"))
         self.scope.add(
@@ -638,28 +750,39 @@ class Writer:
 
         return new_type
 
-    def generate_nested(self, schema: capnp.lib.capnp._StructSchema) -> None:
-        """Generate the type for a nested schema.
+    def _ensure_type(self, schema: capnp.lib.capnp._StructSchema) -> CapnpType | None:
+        """Look up the type of a schema, generating it first if it is not registered yet.
+
+        This is the single guarded entry point for on-demand type generation. Callers do not need
+        to check the type registry themselves before calling it, so the registry lookup only
+        happens once per reference.
 
         Args:
-            schema (capnp.lib.capnp._StructSchema): The schema to generate types for.
+            schema (capnp.lib.capnp._StructSchema): The schema to look up or generate the type for.
 
         Raises:
             AssertionError: If the schema belongs to an unknown type.
+
+        Returns:
+            CapnpType | None: The registered type, or None for nodes that do not register a type.
         """
-        if self.is_type_id_known(schema.node.id):
-            return
+        node = schema.node
+        node_id = node.id
+        known_type = self.type_map.get(node_id)
+
+        if known_type is not None:
+            return known_type
 
-        node_type = schema.node.which()
+        node_type = node.which()
 
         if node_type == "const":
             self.gen_const(schema)
 
         elif node_type == "struct":
-            self.gen_struct(schema)
+            return self.gen_struct(schema)
 
         elif node_type == "enum":
-            self.gen_enum(schema)
+            return self.gen_enum(schema)
 
         elif node_type == "interface":
             logger.warning("Skipping interface: not implemented.")
@@ -670,6 +793,19 @@ class Writer:
         else:
             raise AssertionError(node_type)
 
+        return None
+
+    def generate_nested(self, schema: capnp.lib.capnp._StructSchema) -> None:
+        """Generate the type for a nested schema.
+
+        Args:
+            schema (capnp.lib.capnp._StructSchema): The schema to generate types for.
+
+        Raises:
+            AssertionError: If the schema belongs to an unknown type.
+        """
+        self._ensure_type(schema)
+
     def generate_all_nested(self):
         """Generate types for all nested nodes, recursively."""
         for node in self._module.schema.node.nestedNodes:
@@ -687,21 +823,47 @@ class Writer:
             Type | None: The type of the import, if the schema is imported,
                 or None if the schema defines the base module itself.
         """
-        module_name, definition_name = schema.node.displayName.split(":")
+        module_name, definition_name = self._split_display_name(schema)
 
         if module_name == self.full_display_name:
             # This is the base module, not an import.
             return None
 
-        common_path: str
-        matching_path: pathlib.Path | None = None
+        python_import_path = self._resolve_import_path(schema, module_name, definition_name)
+
+        if python_import_path is None:
+            return None
+
+        # Import the regular definition name, alongside its builder.
+        self._add_import(
+            f"from {python_import_path} import "
+            f"{definition_name}, {helper.new_builder(definition_name)}, {helper.new_reader(definition_name)}"
+        )
+
+        return self.register_type(schema.node.id, schema, name=definition_name, scope=self.scope.root)
+
+    def _resolve_import_path(self, schema: capnp.lib.capnp._StructSchema, module_name: str, definition_name: str) -> str | None:
+        """Resolve the relative Python import path for an imported schema.
+
+        The resolution scans the module registry and normalizes paths, so the result is cached per
+        schema node and reused for subsequent references to the same import.
+
+        Args:
+            schema (capnp.lib.capnp._StructSchema): The imported schema to resolve.
+            module_name (str): The name of the module that defines the schema.
+            definition_name (str): The name of the schema's definition within its module.
+
+        Returns:
+            str | None: The relative Python import path, or None if no defining module was found.
+        """
+        node_id = schema.node.id
+
+        cached_import_path = self._import_path_cache.get(node_id)
+        if cached_import_path is not None:
+            return cached_import_path
 
         # Find the path of the parent module, from which this schema is imported.
-        for path, module in self._module_registry.values():
-            for node in module.schema.node.nestedNodes:
-                if node.id == schema.node.id:
-                    matching_path = pathlib.Path(path)
-                    break
+        matching_path = self._node_owner_paths.get(node_id)
 
         if matching_path is None and isinstance(schema, capnp.lib.capnp._EnumSchema):
             logging.error(f"Could not find the path of the enum {definition_name}.")
@@ -721,13 +883,8 @@ class Writer:
             ".".join(relative_import_path.parts)
         )
 
-        # Import the regular definition name, alongside its builder.
-        self._add_import(
-            f"from {python_import_path} import "
-            f"{definition_name}, {helper.new_builder(definition_name)}, {helper.new_reader(definition_name)}"
-        )
-
-        return self.register_type(schema.node.id, schema, name=definition_name, scope=self.scope.root)
+        self._import_path_cache[node_id] = python_import_path
+        return python_import_path
 
     def register_type_var(self, name: str) -> str:
         """Find and register the full name of a type variable, which includes its scopes.
@@ -758,7 +915,7 @@ class Writer:
             Type: The registered type.
         """
         if not name:
-            name = helper.get_display_name(schema)
+            name = self._get_display_name(schema)
 
         if scope is None:
             scope = self.scope.parent
@@ -837,7 +994,9 @@ class Writer:
         assert self.scope.parent is not None, "The current scope has no parent."
         assert self.scope.return_scope is not None, "The current scope does not define a scope to return to."
 
-        self.scope.parent.lines += self.scope.lines
+        # The child's fragment list is appended as one nested element, instead of copying its lines
+        # into the parent. The fragments are flattened once when the output is dumped.
+        self.scope.parent.lines.append(self.scope.lines)
         self.scope = self.scope.return_scope
 
     def get_type_name(self, type_reader: capnp._DynamicStructReader) -> str:
@@ -852,7 +1011,7 @@ class Writer:
             str: The extracted type name.
         """
         try:
-            return capnp_types.CAPNP_TYPE_TO_PYTHON[type_reader.which()]
+            return capnp_types.CAPNP_TYPE_TO_PYTHON[sys.intern(type_reader.which())]
 
         except KeyError:
             pass
@@ -860,13 +1019,27 @@ class Writer:
         type_reader_type = type_reader.which()
 
         element_type: Any | None = None
+        cache_key: tuple[str, int] | None = None
+
+        if type_reader_type == _ELEMENT_STRUCT:
+            struct_reader = type_reader.struct
+            brand_scopes = struct_reader.brand.scopes
 
-        if type_reader_type == capnp_types.CapnpElementType.STRUCT:
-            element_type = self.get_type_by_id(type_reader.struct.typeId)
+            # Unbranded struct names are fully determined by their node, so they are cached.
+            # Branded names are not, as their cache key would have to include the recursively
+            # resolved brand bindings, which is the very work being avoided.
+            if len(brand_scopes) == 0:
+                cache_key = ("struct", struct_reader.typeId)
+                cached_name = self._type_name_cache.get(cache_key)
+
+                if cached_name is not None:
+                    return cached_name
+
+            element_type = self.get_type_by_id(struct_reader.typeId)
             type_name = element_type.name
             generic_params = []
 
-            for brand_scope in type_reader.struct.brand.scopes:
+            for brand_scope in brand_scopes:
                 brand_scope_type = brand_scope.which()
 
                 if brand_scope_type == "inherit":
@@ -883,70 +1056,110 @@ class Writer:
             if generic_params:
                 type_name += f"[{', '.join(generic_params)}]"
 
-        elif type_reader_type == capnp_types.CapnpElementType.ENUM:
-            element_type = self.get_type_by_id(type_reader.enum.typeId)
+        elif type_reader_type == _ELEMENT_ENUM:
+            cache_key = ("enum", type_reader.enum.typeId)
+            cached_name = self._type_name_cache.get(cache_key)
+
+            if cached_name is not None:
+                return cached_name
+
+            element_type = self.get_type_by_id(cache_key[1])
             type_name = element_type.name
 
-        elif type_reader_type == capnp_types.CapnpElementType.LIST:
+        elif type_reader_type == _ELEMENT_LIST:
             type_name = type_reader.list.elementType.which()
 
             # Traverse down to the innermost nested list element.
-            while type_name == capnp_types.CapnpElementType.LIST:
+            while type_name == _ELEMENT_LIST:
                 type_name += type_reader.list.elementType.which()
 
         else:
             raise TypeError(f"Unknown type reader type '{type_reader_type}'.")
 
         if element_type and (not element_type.scope.is_root):
-            return f"{element_type.scope}.{type_name}"
+            type_name = f"{element_type.scope}.{type_name}"
 
-        else:
-            return type_name
+        if cache_key is not None:
+            self._type_name_cache[cache_key] = type_name
 
-    def dumps_pyi(self) -> str:
-        """Generates string output for the *.pyi stub file that provides type hinting.
+        return type_name
 
-        Returns:
-            str: The output string.
+    def dump_pyi(self, buffer: TextIO) -> None:
+        """Writes the output for the *.pyi stub file that provides type hinting to a buffer.
+
+        Streaming into a buffer avoids holding a second full copy of the output in memory
+        next to the accumulated scope lines.
+
+        Args:
+            buffer (TextIO): The buffer to write the output to.
         """
         assert self.scope.is_root
 
-        out = []
-        out.append(self.docstring)
-        out.extend(self.imports)
-        out.append("")
+        write = buffer.write
+        write(self.docstring)
+
+        for import_line in self.imports:
+            write("\n")
+            write(import_line)
+
+        write("\n")
 
         if self.type_vars:
             for name in sorted(self.type_vars):
-                out.append(f'{name} = TypeVar("{name}")')
-            out.append("")
+                write(f'\n{name} = TypeVar("{name}")')
 
-        out.extend(self.scope.lines)
-        return "\n".join(out)
+            write("\n")
 
-    def dumps_py(self) -> str:
-        """Generates string output for the *.py stub file that handles the import of capnproto schemas.
+        for line in self.scope.flattened_lines():
+            write("\n")
+            write(line)
+
+    def dumps_pyi(self) -> str:
+        """Generates string output for the *.pyi stub file that provides type hinting.
 
         Returns:
             str: The output string.
         """
+        buffer = io.StringIO()
+        self.dump_pyi(buffer)
+        return buffer.getvalue()
+
+    def dump_py(self, buffer: TextIO) -> None:
+        """Writes the output for the *.py stub file that handles the import of capnproto schemas to a buffer.
+
+        Args:
+            buffer (TextIO): The buffer to write the output to.
+        """
         assert self.scope.is_root
 
-        out = []
-        out.append(self.docstring)
-        out.append("import os")
-        out.append("import capnp # type: ignore")
-        out.append("capnp.remove_import_hook()")
-        out.append("here = os.path.dirname(os.path.abspath(__file__))")
+        write = buffer.write
+        write(self.docstring)
+        write("\nimport os")
+        write("\nimport capnp # type: ignore")
+        write("\ncapnp.remove_import_hook()")
+        write("\nhere = os.path.dirname(os.path.abspath(__file__))")
+
+        write(f'\nmodule_file = os.path.abspath(os.path.join(here, "{self.display_name}"))')
+        write("\nmodule = capnp.load(module_file)  # pylint: disable=no-member")
+
+        # The parent chain of a scope is cached, so a scope is top-level exactly if its parent has
+        # no further parents. This avoids walking the property chain for every scope in the registry.
+        top_level_scopes = [
+            scope for scope in self.scopes_by_id.values() if scope.parent is not None and not scope.parent._parents
+        ]
 
-        out.append(f'module_file = os.path.abspath(os.path.join(here, "{self.display_name}"))')
-        out.append("module = capnp.load(module_file)  # pylint: disable=no-member")
+        for scope in top_level_scopes:
+            write(f"\n{scope.name} = module.{scope.name}")
+            if scope.type == "struct":
+                write(f"\n{helper.new_builder(scope.name)} = {scope.name}")
+                write(f"\n{helper.new_reader(scope.name)} = {scope.name}")
 
-        for scope in self.scopes_by_id.values():
-            if scope.parent is not None and scope.parent.is_root:
-                out.append(f"{scope.name} = module.{scope.name}")
-                if scope.type == "struct":
-                    out.append(f"{helper.new_builder(scope.name)} = {scope.name}")
-                    out.append(f"{helper.new_reader(scope.name)} = {scope.name}")
+    def dumps_py(self) -> str:
+        """Generates string output for the *.py stub file that handles the import of capnproto schemas.
 
-        return "\n".join(out)
+        Returns:
+            str: The output string.
+        """
+        buffer = io.StringIO()
+        self.dump_py(buffer)
+        return buffer.getvalue()
@@ -0,0 +1,63 @@
+"""Tests the glob pattern matching that is used for schema discovery."""
+from __future__ import annotations
+
+import glob
+import os
+
+import pytest
+
+from capnp_stub_generator.run import _match_paths
+from capnp_stub_generator.run import _static_prefix
+
+
+@pytest.fixture(name="schema_tree")
+def schema_tree_fixture(tmp_path):
+    """Create a small file tree with nested, hidden and non-schema files."""
+    for relative_path in [
+        "a.capnp",
+        "other.txt",
+        "sub/b.capnp",
+        "sub/deep/c.capnp",
+        "sub/.hidden/d.capnp",
+        "sub/.e.capnp",
+        ".top/f.capnp",
+    ]:
+        file_path = tmp_path / relative_path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.touch()
+
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize(
+    ["pattern", "recursive"],
+    [
+        ("**/*.capnp", True),
+        ("*.capnp", False),
+        ("*/*.capnp", False),
+        ("sub/*.capnp", False),
+        ("sub/deep/*.capnp", False),
+        ("sub/**/*.capnp", True),
+        ("sub/.hidden/*.capnp", False),
+        ("**/.hidden/*.capnp", True),
+        (".top/*.capnp", False),
+        ("sub/.*.capnp", False),
+        ("sub/deep/c.capnp", False),
+        ("missing/*.capnp", True),
+    ],
+)
+def test_match_paths_glob_parity(schema_tree, pattern, recursive):
+    """The single-walk matcher finds exactly the files that `glob.glob` finds."""
+    expected = set(glob.glob(os.path.join(schema_tree, pattern), recursive=recursive))
+    matches = _match_paths(schema_tree, {"paths": [pattern]}, recursive)
+
+    assert matches["paths"] == expected
+
+
+def test_static_prefix():
+    """The static prefix keeps every literal directory up to the first wildcard."""
+    assert _static_prefix(os.sep.join(["", "tmp", "globtest", "**", "*.capnp"])) == os.sep.join(["", "tmp", "globtest"])
+    assert _static_prefix(os.sep.join(["sub", "dir", "*.capnp"])) == os.sep.join(["sub", "dir"])
+    assert _static_prefix(os.sep.join(["sub", "literal.capnp"])) == "sub"
+    assert _static_prefix(os.sep.join(["**", "*.capnp"])) == os.curdir
+    assert _static_prefix(os.sep.join(["", "*x", "y.capnp"])) == os.sep
@@ -0,0 +1,39 @@
+"""Tests the up-to-date check that skips regeneration of unchanged schemas."""
+from __future__ import annotations
+
+import os
+import pathlib
+
+from capnp_stub_generator.run import _output_file_path
+from capnp_stub_generator.run import _outputs_up_to_date
+from capnp_stub_generator.run import PY_SUFFIX
+from capnp_stub_generator.run import PYI_SUFFIX
+
+
+def _write(path, content: str, mtime_ns: int):
+    """Write a file and set its modification time."""
+    path.write_text(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_outdated_through_import(tmp_path):
+    """A schema becomes outdated when an imported schema is newer than its outputs."""
+    base_path = tmp_path / "base.capnp"
+    top_path = tmp_path / "top.capnp"
+
+    _write(base_path, '@0xbf5147cbbecf40c1;\nstruct Base {\n    value @0 :Int32;\n}\n', 1_000)
+    _write(top_path, '@0x9eb32e19f86ee174;\nusing Base = import "base.capnp";\n', 1_000)
+
+    for schema_path in (base_path, top_path):
+        for suffix in (PYI_SUFFIX, PY_SUFFIX):
+            _write(pathlib.Path(_output_file_path(str(schema_path)) + suffix), "", 2_000)
+
+    import_roots = (str(tmp_path),)
+
+    assert _outputs_up_to_date(str(top_path), import_roots)
+
+    # Touching the imported schema outdates the importing schema's outputs as well.
+    os.utime(base_path, ns=(3_000, 3_000))
+
+    assert not _outputs_up_to_date(str(base_path), import_roots)
+    assert not _outputs_up_to_date(str(top_path), import_roots)